@@ -1,5 +1,19 @@
 #!/usr/bin/python3.5
 
+import argparse
+import collections
+import concurrent.futures
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import urllib.request
+import zipfile
+
+import colorama
+
 class Main(object):
 	"""
 	Main program module, handles setting up the environment,
@@ -7,7 +21,7 @@ class Main(object):
 	program
 	"""
 	def __init__(self):
-		self.handleImports()
+		colorama.init()
 
 		self.useregex = False
 		self.ignoreCase = False
@@ -16,28 +30,6 @@ class Main(object):
 		args = self.addArguments()
 		self.invokeMain(args)
 
-	def handleImports(self):
-		"""
-		Import required packages or fail
-		"""
-		packages = ['sqlite3', 're', 'sys', 'argparse', 'tempfile', 'shutil', 'os', 'zipfile', 'colorama']
-		missingPackages = []
-
-		for p in packages:
-			try:
-				lib = __import__(p)
-				globals()[p] = lib
-			except Exception as e:
-				print(e)
-				missingPackages.append(p)
-
-		colorama.init()
-
-		if len(missingPackages) > 0:
-			print("The following packages are required (Consider using `pip install` tool):")
-			print("\t" + ", ".join(missingPackages))
-			exit(1)
-
 	def addArguments(self):
 		"""
 		Create an argument parser object with the available arguments
@@ -114,9 +106,9 @@ class EWDatabaseRewriter(object):
 		@param ignorecase 	Ignore case while searching for search string
 		@param database		Name of the database file
 		"""
-		self.conn = sqlite3.connect(database)
-		self.c = self.conn.cursor()
+		self.database = database
 		self.dryRun = dryRun
+		self.searchstring = search
 		self.replacewith = replace
 		self.ignorecase = ignoreCase
 
@@ -128,21 +120,51 @@ class EWDatabaseRewriter(object):
 				self.input = re.compile(search, re.IGNORECASE)
 			else:
 				self.input = re.compile(search)
+			self.regexSubn = self.input.subn
 		else:
 			self.searchValue = self.searchValuePlain
 			self.printDifference = self.printDifferencePlain
 			self.substituteValue = self.substituteValuePlain
 			self.input = search
+			self.plainPattern = re.compile(re.escape(search), re.IGNORECASE if self.ignorecase else 0)
+			self.plainReplacement = replace.replace("\\", "\\\\")
+
+		# Case sensitive plain text searches are evaluated by SQLite's instr(). SQLite
+		# only folds ASCII characters, so all other searches are evaluated by
+		# searchValue through a REGEXP function registered on the connection
+		self.useInstr = not useregex and not self.ignorecase
+
+		self.conn = self.openConnection()
+		self.c = self.conn.cursor()
+		self.c.arraysize = 4096
 
 		self.runReplacement()
 
+	def openConnection(self, readOnly = False):
+		"""
+		Open a connection to the database and prepare it for searching
+		@param readOnly 	Open the database in read only mode
+		@return Connection object
+		"""
+		if readOnly:
+			uri = "file:{0}?mode=ro".format(urllib.request.pathname2url(os.path.abspath(self.database)))
+			conn = sqlite3.connect(uri, uri=True)
+		else:
+			# Transactions are managed explicitly in startReplacement
+			conn = sqlite3.connect(self.database, isolation_level=None, cached_statements=256)
+
+		if not self.useInstr:
+			conn.create_function("REGEXP", 2, self.sqlSearchValue)
+
+		return conn
+
 	def runReplacement(self):
 		"""
 		Default flow for this class. Run the replacement function only on those tables and
 		columns that contain the specified search string
 		"""
 		tables = self.getTables()
-		tables_with_string, found_occurences = self.getTablesWhereStringExists(tables, self.input)
+		tables_with_string, found_occurences = self.getTablesWhereStringExists(tables)
 		if found_occurences > 0:
 			self.startReplacement(tables_with_string, self.input, self.replacewith, found_occurences)
 		else:
@@ -159,28 +181,102 @@ class EWDatabaseRewriter(object):
 		result = self.c.execute("select name from sqlite_master where type = 'table'")
 		return [t[0] for t in result]
 
-	def getTablesWhereStringExists(self, tables, search):
+	def getColumns(self, cursor, table):
+		"""
+		Get a list of all columns in a table. Text can be stored in a column of
+		any declared type, so non-text values are filtered out by the search
+		condition instead
+		@param cursor 	Cursor to query the database with
+		@param table 	Name of the table
+		@return List of column names
+		"""
+		result = cursor.execute("PRAGMA table_info({0})".format(self.quoteIdentifier(table)))
+		return [r[1] for r in result]
+
+	def quoteIdentifier(self, identifier):
+		"""
+		Quote a table or column name for use in an SQL query
+		@param identifier 	Name of the table or column
+		@return The quoted identifier
+		"""
+		return '"{0}"'.format(identifier.replace('"', '""'))
+
+	def getSearchCondition(self, column):
+		"""
+		Build the SQL condition selecting those rows where the given column
+		contains the search string, so filtering happens inside SQLite
+		@param column 	Name of the column to search in
+		@return Tuple of the condition and its query parameters
+		"""
+		col = self.quoteIdentifier(column)
+		if self.useInstr:
+			return "typeof({0}) = 'text' and instr({0}, ?) > 0".format(col), (self.searchstring,)
+		else:
+			return "typeof({0}) = 'text' and {0} regexp ?".format(col), (self.searchstring,)
+
+	def sqlSearchValue(self, pattern, value):
+		"""
+		Implementation of the SQLite REGEXP function, which applies searchValue
+		to a value in the database
+		@param pattern 	Right hand side of the REGEXP operator (unused, the search
+						string given to the constructor is used instead)
+		@param value 	The haystack
+		@return 	Bool if value contains the search string
+		"""
+		return isinstance(value, str) and bool(self.searchValue(self.input, value))
+
+	def getColumnsWhereStringExists(self, table):
+		"""
+		Count the occurences of the search string in each column of a table,
+		using a new read only connection so it can run in a separate thread
+		@param table 	Name of the table
+		@return Tuple of the table name, a set of column names where the search
+			string occurs and the number of occurences
+		"""
+		conn = self.openConnection(True)
+		c = conn.cursor()
+		columns = set()
+		total_occurences = 0
+
+		try:
+			for col in self.getColumns(c, table):
+				condition, params = self.getSearchCondition(col)
+				res = c.execute("select count(*) from {0} where {1}".format(self.quoteIdentifier(table), condition), params)
+				count = res.fetchone()[0]
+				if count > 0:
+					columns.add(col)
+					total_occurences += count
+		finally:
+			c.close()
+			conn.close()
+
+		return table, columns, total_occurences
+
+	def getTablesWhereStringExists(self, tables):
 		"""
 		Check which tables contain the string to replace
+		@param tables 	List of table names to search in
 		@return Dictionary of table names as keys and list of column names as values
 			of tables and columns where search string occurs
 		"""
-		tables_with_string = dict()
+		tables_with_string = collections.defaultdict(set)
 		total_occurences = 0.0
 
-		for t in tables:
-			res = self.c.execute("select * from " + t)
-			names = list(map(lambda x: x[0], self.c.description))
-			for r in res:
-				for i, cell in enumerate(list(r)):
-					if isinstance(cell, str):
-						if self.searchValue(search, cell):
-							try:
-								if names[i] not in tables_with_string[t]:
-									tables_with_string[t].append(names[i])
-							except:
-								tables_with_string[t] = [names[i]]
-							total_occurences += 1
+		# Searching only reads from the database, so every table can be scanned by
+		# its own connection in parallel. This only pays off for instr() searches:
+		# the Python REGEXP function holds the GIL, which serializes the threads
+		if self.useInstr:
+			with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+				results = list(executor.map(self.getColumnsWhereStringExists, tables))
+		else:
+			results = map(self.getColumnsWhereStringExists, tables)
+
+		for t, columns, count in results:
+			if count > 0:
+				tables_with_string[t].update(columns)
+				total_occurences += count
+
+		tables_with_string = dict((t, sorted(cols)) for t, cols in tables_with_string.items())
 
 		print("Found %i occurences in %s tables:" % (total_occurences, len(tables_with_string)))
 		
@@ -202,31 +298,60 @@ class EWDatabaseRewriter(object):
 		@param expectedTotal The number of entries to update (used for progress).
 		"""
 		replaced_count = 0.0
+		progress_step = max(1, int(expectedTotal // 100))
 
 		if not self.dryRun:
 			print("Starting replacing in database")
 			print("")
+			# The database is a temporary copy, so durability can be traded for
+			# speed. All updates are performed in a single transaction
+			self.c.execute("PRAGMA journal_mode = MEMORY")
+			self.c.execute("PRAGMA synchronous = OFF")
+			self.c.execute("PRAGMA temp_store = MEMORY")
+			self.c.execute("BEGIN")
+
+		# Bind attributes used for every row to local names outside the loops
+		dry_run = self.dryRun
+		substitute_value = self.substituteValue
+		print_difference = self.printDifference
 
 		for t in tables.keys():
 			for col in tables[t]:
-				result = self.c.execute('select rowid, {0} from {1}'.format(col, t))
-				c2 = self.conn.cursor()
-				for r in result:
-					value = r[1]
-					if self.searchValue(search, value):
-						replaced_col = self.substituteValue(search, replace, value)
-						if self.dryRun:
-							self.printDifference(search, replace, value, replaced_col)
-						else:
-							query = "update `{0}` set `{1}`=? where `rowid`=?".format(t, col)
-							c2.execute(query, (replaced_col, r[0]))
-							if (replaced_count % 20 == 0):
-								sys.stdout.write("\r%i%%                " % (replaced_count / expectedTotal * 100.0))
-								sys.stdout.flush()
-						replaced_count += 1
-				if not self.dryRun:
-					self.conn.commit()
-				c2.close()
+				if self.useInstr and not self.dryRun:
+					replaced_count += self.replaceInDatabase(t, col, search, replace)
+					self.printProgress(replaced_count, expectedTotal)
+				else:
+					condition, params = self.getSearchCondition(col)
+					# Matching rows are read in batches ordered by rowid, and every batch is
+					# written back before the next one is selected. This bounds memory to
+					# one batch, without updating the table while a select is pending
+					select = 'select rowid, {0} from {1} where {2} order by rowid limit ?'.format(
+						self.quoteIdentifier(col), self.quoteIdentifier(t), condition
+					)
+					select_next = 'select rowid, {0} from {1} where rowid > ? and {2} order by rowid limit ?'.format(
+						self.quoteIdentifier(col), self.quoteIdentifier(t), condition
+					)
+					query = "update {0} set {1}=? where `rowid`=?".format(self.quoteIdentifier(t), self.quoteIdentifier(col))
+					rows = self.c.execute(select, params + (self.c.arraysize,)).fetchall()
+					while rows:
+						updates = []
+						add_update = updates.append
+						for rowid, value in rows:
+							replaced_col, n = substitute_value(search, replace, value)
+							if n:
+								if dry_run:
+									print_difference(search, replace, value, replaced_col)
+								else:
+									add_update((replaced_col, rowid))
+									if (replaced_count % progress_step == 0):
+										self.printProgress(replaced_count, expectedTotal)
+								replaced_count += 1
+						if updates:
+							self.c.executemany(query, updates)
+						rows = self.c.execute(select_next, (rows[-1][0],) + params + (self.c.arraysize,)).fetchall()
+
+		if not self.dryRun:
+			self.conn.commit()
 
 		print(
 			"\r{3}\n{2} {0} items in {1} tables: ".format(
@@ -239,17 +364,43 @@ class EWDatabaseRewriter(object):
 		for t in tables.keys():
 			print("\t{0} (columns: {1})".format(bcolors.okblue(t), ", ".join(map(lambda x: bcolors.okblue(x), tables[t]))))
 
+	def printProgress(self, count, expectedTotal):
+		"""
+		Show the percentage of replaced entries on standard error, so progress
+		does not mix with the regular output
+		@param count 		The number of entries replaced so far
+		@param expectedTotal The number of entries to update
+		"""
+		sys.stderr.write("\r%i%%                " % (count / expectedTotal * 100.0))
+
+	def replaceInDatabase(self, table, column, search, replace):
+		"""
+		Replace all occurences of a plain, case sensitive search string in a
+		column using the replace() function of SQLite, so no values have to be
+		transferred to Python
+		@param table 	Name of the table to update
+		@param column 	Name of the column to update
+		@param search 	The string to replace within the database
+		@param replace 	The replacement for search
+		@return The number of updated rows
+		"""
+		condition, params = self.getSearchCondition(column)
+		col = self.quoteIdentifier(column)
+		result = self.c.execute(
+			'update {0} set {1} = replace({1}, ?, ?) where {2}'.format(self.quoteIdentifier(table), col, condition),
+			(search, replace) + params
+		)
+		return result.rowcount
+
 	def searchValuePlain(self, searchstring, value):
 		"""
-		Perform a non-regex search on a string
+		Perform a non-regex search on a string, using the pattern precompiled
+		in the constructor
 		@param searchstring 	The needle to look for
 		@param value 			The haystack
 		@return 	Bool if value contains searchstring
 		"""
-		if self.ignorecase:
-			return searchstring.lower() in value.lower()
-		else:
-			return searchstring in value
+		return self.plainPattern.search(value) is not None
 
 	def searchValueRegex(self, searchstring, value):
 		"""
@@ -263,28 +414,14 @@ class EWDatabaseRewriter(object):
 	def substituteValuePlain(self, searchstring, replacement, value):
 		"""
 		Substitute all occurences of the searchstring for the replacement in the 
-		given value
+		given value, using the pattern precompiled in the constructor
 
 		@param searchstring 	The needle to look for
 		@param replacement 		The value to replace the searchstring with
 		@param value 			The haystack
-		@return 	The updated string
+		@return 	Tuple of the updated string and the number of substitutions made
 		"""
-		if self.ignorecase:
-			return value.replace(searchstring, replacement)
-		else:
-			newstr = ""
-			lastIndex = 0
-			while lastIndex < len(value):
-				index = value.lower().find(searchstring.lower(), lastIndex)
-				if index < 0:
-					newstr += value[lastIndex:]
-					lastIndex = len(value)
-				else:
-					newstr += value[lastIndex:index]
-					newstr += replacement
-					lastIndex = index + len(searchstring)
-			return newstr
+		return self.plainPattern.subn(self.plainReplacement, value)
 
 	def substituteValueRegex(self, searchstring, replacement, value):
 		"""
@@ -294,9 +431,9 @@ class EWDatabaseRewriter(object):
 		@param searchstring 	The needle regex to look for
 		@param replacement 		The value to replace the searchstring with
 		@param value 			The haystack
-		@return 	The updated string
+		@return 	Tuple of the updated string and the number of substitutions made
 		"""
-		return re.sub(searchstring, replacement, value)
+		return self.regexSubn(replacement, value)
 
 	def printDifferencePlain(self, search, replace, value, newValue):
 		"""
@@ -307,37 +444,29 @@ class EWDatabaseRewriter(object):
 		@param newValue The output of the substitute method which took the other 
 						three parameters as arguments
 		"""
-		searchlen = len(search)
-		replacelen = len(replace)
-		stdDiscrepency = replacelen - searchlen
-		original = bcolors.fail('- ')
-		new = bcolors.okgreen('+ ')
+		original = [bcolors.fail('- ')]
+		new = [bcolors.okgreen('+ ')]
 		lastIndex = 0
-		discrepency = 0
 		while lastIndex < len(value):
-			if self.ignorecase:
-				index = value.lower().find(search.lower(), lastIndex) 
-			else:
-				index = value.find(search, lastIndex)
-			print(index, lastIndex)
+			match = self.plainPattern.search(value, lastIndex)
+			if match is None:
+				break
+			index = match.start()
 
-			if index < 0:
-				lastIndex = len(value)
-			else:
-				original += value[lastIndex:index]
-				original += bcolors.fail(value[index:index+searchlen])
+			# Text between matches is identical in the original and new value
+			original.append(value[lastIndex:index])
+			original.append(bcolors.fail(match.group()))
 
-				new += newValue[lastIndex+discrepency:index+discrepency]
-				new += bcolors.okgreen(replace)
+			new.append(value[lastIndex:index])
+			new.append(bcolors.okgreen(replace))
 
-				lastIndex = index + searchlen
-				discrepency -= stdDiscrepency
+			lastIndex = match.end()
 
-			original += value[lastIndex:]
-			new += newValue[lastIndex+discrepency:]
+		original.append(value[lastIndex:])
+		new.append(value[lastIndex:])
 
-		print(original)
-		print(new)
+		print("".join(original))
+		print("".join(new))
 		print("\n")
 
 	def printDifferenceRegex(self, search, replace, value, newValue):
@@ -350,32 +479,32 @@ class EWDatabaseRewriter(object):
 						three parameters as arguments
 		"""
 		matches = search.finditer(value)
-		original = bcolors.fail('- ')
-		new = bcolors.okgreen("+ ")
+		original = [bcolors.fail('- ')]
+		new = [bcolors.okgreen("+ ")]
 		lastIndex = 0
 		discrepency = 0
 		for m in matches:
-			sublen = len(re.sub(search, replace, value[m.start():m.end()]))
+			sublen = len(m.expand(replace))
 
-			original += value[lastIndex:m.start()]
-			original += bcolors.fail(value[m.start():m.end()])
+			original.append(value[lastIndex:m.start()])
+			original.append(bcolors.fail(value[m.start():m.end()]))
 			
-			new += newValue[lastIndex+discrepency:m.start()+discrepency]
-			new += bcolors.okgreen(newValue[m.start()+discrepency:m.start()+discrepency+sublen])
+			new.append(newValue[lastIndex+discrepency:m.start()+discrepency])
+			new.append(bcolors.okgreen(newValue[m.start()+discrepency:m.start()+discrepency+sublen]))
 
 			lastIndex = m.end()
 			discrepency += sublen - (m.end() - m.start())
 
-		original += value[lastIndex:]
-		new += newValue[lastIndex+discrepency:]
+		original.append(value[lastIndex:])
+		new.append(newValue[lastIndex+discrepency:])
 
-		print(original)
-		print(new)
+		print("".join(original))
+		print("".join(new))
 		print("\n")
 
 class ScheduleExtractor(object):
 	"""
-	Class for extracting the contents of an EasyWorship schedule
+	Class for extracting the database of an EasyWorship schedule
 	file (.ewsx) to a hidden directory on the system, repacking
 	the results after manipulation of the database, and cleaning up
 	"""
@@ -392,17 +521,15 @@ class ScheduleExtractor(object):
 
 	def extractSchedule(self):
 		"""
-		Extract the EasyWorship Schedule (.ewsx) file to a hidden directory
-		on the system
+		Extract the database from the EasyWorship Schedule (.ewsx) file to a
+		hidden directory on the system. All other files are copied directly
+		from the schedule when zipping the results
 		@return Absolute path to the extracted data on the system
 		"""
 		self.tempdir = tempfile.mkdtemp()
-		self.ziptarget = os.path.abspath(os.path.join(self.tempdir, 'tempschedule.zip'))
 		self.zipcontenttarget = os.path.abspath(os.path.join(self.tempdir, 'scheduleContents'))
-		shutil.copy(self.input, self.ziptarget)
-		zip_ref = zipfile.ZipFile(self.ziptarget, 'r')
-		zip_ref.extractall(self.zipcontenttarget)
-		zip_ref.close()
+		with zipfile.ZipFile(self.input, 'r') as zip_ref:
+			zip_ref.extract('main.db', self.zipcontenttarget)
 		if self.writestatus:
 			print(
 				"Finished extraction of {0} to {1}".format(
@@ -416,17 +543,70 @@ class ScheduleExtractor(object):
 	def zipResults(self):
 		"""
 		Zip the results of the database replacement and write the results
-		to the specified output file
-		"""
-		zip_ref = zipfile.ZipFile(self.output, 'w', zipfile.ZIP_DEFLATED)
-		for dirname, subdirs, files in os.walk(self.zipcontenttarget):
-			if dirname is not self.zipcontenttarget:
-				zip_ref.write(dirname, os.path.relpath(dirname, self.zipcontenttarget))
-			for filename in files:
-				realpath = os.path.join(dirname, filename)
-				relpath = os.path.relpath(realpath, self.zipcontenttarget)
-				zip_ref.write(realpath, relpath)
-		zip_ref.close()
+		to the specified output file. The archive is written to a temporary
+		file next to the output first, so a failure never leaves a partial
+		output behind and the output may be the input schedule itself
+		"""
+		# Media files are compressed already, deflating them again only costs time
+		storedExtensions = ('.jpg', '.jpeg', '.png', '.gif', '.mp3', '.mp4', '.m4v', '.mov', '.wmv', '.avi', '.zip')
+		options = dict()
+		if sys.version_info >= (3, 7):
+			options['compresslevel'] = 1
+
+		fd, partial = tempfile.mkstemp(suffix='.ewsx', dir=os.path.dirname(self.output))
+		try:
+			with zipfile.ZipFile(self.input, 'r') as zip_in, \
+					os.fdopen(fd, 'wb', buffering=1024 * 1024) as out, \
+					zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED, **options) as zip_ref:
+				for info in zip_in.infolist():
+					if info.filename == 'main.db':
+						zip_ref.write(os.path.join(self.zipcontenttarget, info.filename), info.filename)
+					elif info.filename.lower().endswith(storedExtensions):
+						self.copyEntry(zip_in, zip_ref, info, zipfile.ZIP_STORED)
+					else:
+						self.copyEntry(zip_in, zip_ref, info, info.compress_type)
+			# mkstemp creates the file readable by its owner only, so give it the
+			# mode of the file it replaces, or the default mode for a new file
+			if os.path.isfile(self.output):
+				shutil.copymode(self.output, partial)
+			else:
+				umask = os.umask(0)
+				os.umask(umask)
+				os.chmod(partial, 0o666 & ~umask)
+			os.replace(partial, self.output)
+		except:
+			os.remove(partial)
+			raise
+
+	def copyEntry(self, zip_in, zip_ref, info, compress_type):
+		"""
+		Copy a single entry from the input schedule to the output archive
+		in chunks, so large media files are never held in memory completely
+		@param zip_in 			ZipFile object of the input schedule
+		@param zip_ref 			ZipFile object of the output archive
+		@param info 			ZipInfo object of the entry to copy
+		@param compress_type 	Compression method for the entry in the output
+		"""
+		if sys.version_info >= (3, 6):
+			newinfo = zipfile.ZipInfo(info.filename, info.date_time)
+			newinfo.comment = info.comment
+			newinfo.create_system = info.create_system
+			newinfo.external_attr = info.external_attr
+			newinfo.compress_type = compress_type
+			# Lets zipfile decide up front whether the entry needs ZIP64 extensions
+			newinfo.file_size = info.file_size
+			if info.is_dir():
+				zip_ref.writestr(newinfo, b'')
+			else:
+				with zip_in.open(info) as source, zip_ref.open(newinfo, 'w') as target:
+					shutil.copyfileobj(source, target, 1024 * 1024)
+		else:
+			# Writing to an entry of a ZipFile is only possible from Python 3.6 on,
+			# so the entry is extracted to disk and written from there instead
+			path = zip_in.extract(info, self.zipcontenttarget)
+			zip_ref.write(path, info.filename, compress_type=compress_type)
+			if os.path.isfile(path):
+				os.remove(path)
 
 	def getAbsoluteOutPath(self, out):
 		"""
@@ -466,20 +646,25 @@ class ScheduleExtractor(object):
 		"""
 		return self.output
 
+_BLUE = colorama.Fore.BLUE
+_GREEN = colorama.Fore.GREEN
+_RED = colorama.Fore.RED
+_RESET = colorama.Style.RESET_ALL
+
 class bcolors:
     
     @staticmethod
     def okblue(s):
-    	return colorama.Fore.BLUE + s + colorama.Style.RESET_ALL
+    	return _BLUE + s + _RESET
 
     @staticmethod
     def okgreen(s):
-    	return colorama.Fore.GREEN + s + colorama.Style.RESET_ALL
+    	return _GREEN + s + _RESET
 
 
     @staticmethod
     def fail(s):
-    	return colorama.Fore.RED + s + colorama.Style.RESET_ALL
+    	return _RED + s + _RESET
 
 if __name__ == "__main__":
 	Main()
\ No newline at end of file